@@ -0,0 +1,156 @@
+import logging
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+
+class TokenBucket:
+    """Classic token bucket: refills `rate` tokens per second up to `capacity`"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self, now: float, amount: float = 1.0) -> bool:
+        """Take `amount` tokens if available"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+
+class AdmissionController:
+    """Token-bucket admission control for command handlers.
+
+    Every command is charged against a per-user and a per-chat bucket. When the
+    number of received but unfinished updates passes `max_backlog`, new commands
+    are shed without any work. Update intake (the webhook handler, the polling
+    loop) reports that number through enter() and leave(). Users over their own
+    limit get a short notice at most once per `notice_interval` seconds; chat
+    throttling and shedding drop commands silently.
+    """
+
+    def __init__(self, user_rate: float = 0.2, user_burst: float = 3, chat_rate: float = 1.0,
+                 chat_burst: float = 10, max_backlog: int = 50, notice_interval: float = 60,
+                 max_buckets: int = 10000, exempt_user_ids: tuple = ()):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_backlog = max_backlog
+        self.notice_interval = notice_interval
+        self.max_buckets = max_buckets
+        self.exempt_user_ids = set(exempt_user_ids)
+
+        # Buckets keyed by ('user', id) / ('chat', id), least recently used first
+        self._buckets = OrderedDict()
+        # Last time a throttle notice was sent to each user
+        self._notified = OrderedDict()
+        # Commands currently being processed
+        self.in_flight = 0
+        # Updates received from Telegram and not finished yet, reported by update intake
+        self.pending = 0
+        # Optional callable returning the number of updates waiting in a queue that is not counted in pending
+        self.pending_updates = None
+
+        self.counters = {
+            'admitted': 0,
+            'throttled_user': 0,
+            'throttled_chat': 0,
+            'shed': 0,
+            'notices_sent': 0,
+        }
+        self.logger = logging.getLogger(__name__)
+
+    def _bucket(self, key: tuple, rate: float, capacity: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, capacity)
+            # Evict the least recently used bucket; an evicted key simply starts full again
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def enter(self, count: int = 1):
+        """Record updates that were received and are waiting to be processed"""
+        self.pending += count
+
+    def leave(self, count: int = 1):
+        """Record updates that have finished processing"""
+        self.pending = max(self.pending - count, 0)
+
+    def backlog(self) -> int:
+        """Number of received updates not finished yet, including any still in a queue"""
+        queued = self.pending_updates() if self.pending_updates else 0
+        return self.pending + queued
+
+    def check(self, user_id: int, chat_id: int) -> str:
+        """Return None if the command is admitted, otherwise the counter name for the rejection"""
+        if user_id in self.exempt_user_ids:
+            return None
+        # The update being checked is itself part of the backlog
+        if self.backlog() > self.max_backlog:
+            return 'shed'
+
+        now = time.monotonic()
+        if user_id is not None and not self._bucket(('user', user_id), self.user_rate, self.user_burst).consume(now):
+            return 'throttled_user'
+        if chat_id is not None and not self._bucket(('chat', chat_id), self.chat_rate, self.chat_burst).consume(now):
+            return 'throttled_chat'
+        return None
+
+    def _should_notify(self, user_id: int) -> bool:
+        now = time.monotonic()
+        last = self._notified.get(user_id)
+        if last is not None and now - last < self.notice_interval:
+            return False
+        self._notified[user_id] = now
+        self._notified.move_to_end(user_id)
+        if len(self._notified) > self.max_buckets:
+            self._notified.popitem(last=False)
+        return True
+
+    def limit(self, callback, notice: str = "⏳ Slow down! Please wait a moment before using this command again."):
+        """Wrap a command callback with admission control"""
+        @wraps(callback)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            user_id = update.effective_user.id if update.effective_user else None
+            chat_id = update.effective_chat.id if update.effective_chat else None
+
+            rejection = self.check(user_id, chat_id)
+            if rejection:
+                self.counters[rejection] += 1
+                self.logger.debug(f"Rejected {callback.__name__} from user {user_id} in chat {chat_id}: {rejection}")
+                # Only a user over their own limit is told, once per notice interval; shed and
+                # chat-throttled commands are dropped silently so a busy chat gets no extra replies
+                if rejection == 'throttled_user' and notice and update.message and self._should_notify(user_id):
+                    self.counters['notices_sent'] += 1
+                    try:
+                        await update.message.reply_text(notice)
+                    except Exception as e:
+                        self.logger.error(f"Could not send throttle notice: {e}")
+                return
+
+            self.counters['admitted'] += 1
+            self.in_flight += 1
+            try:
+                return await callback(update, context)
+            finally:
+                self.in_flight -= 1
+
+        return wrapper
+
+    def stats(self) -> dict:
+        """Snapshot of the throttle counters"""
+        return dict(self.counters, in_flight=self.in_flight, backlog=self.backlog(), buckets=len(self._buckets))
@@ -1,10 +1,43 @@
 import aiosqlite
+import asyncio
 import logging
 import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from membership_index import MembershipIndex
 
 class Database:
-    def __init__(self, db_name: str = "referral_bot.db"):
+    # Columns produced by iter_export_rows, in order
+    EXPORT_COLUMNS = (
+        'telegram_id', 'inviter_id', 'is_member', 'has_chatted', 'join_date', 'season_id',
+        'message_count', 'last_active', 'referrals', 'total_referrals', 'active_referrals', 'network_size',
+    )
+
+    def __init__(self, db_name: str = "referral_bot.db", active_min_messages: int = 0, active_days: int = None,
+                 tree_max_depth: int = 10):
         self.db_name = db_name
+        # Deepest referral level kept in the ancestor (closure) index
+        self.tree_max_depth = tree_max_depth
+        # Activity thresholds for an "active" referral: at least N messages within the last M days.
+        # The defaults keep the original definition (the user has chatted at least once).
+        self.active_min_messages = active_min_messages
+        self.active_days = active_days
+        # Per-user message counters buffered in memory and flushed to the database in batches.
+        # Maps telegram_id -> [pending message count, last seen timestamp, {day: pending count}]
+        self._activity_buffer = {}
+        self._activity_lock = asyncio.Lock()
+        # Users known to have has_chatted set in the database (a cache, safe to clear)
+        self._chatted_seen = set()
+        # Current leaderboard season, loaded in init_db and bumped by start_new_season
+        self.current_season = 1
+        # Optional in-memory copy of membership state, see load_membership_index
+        self.index = None
+        # Shared connection while a batch is open, (user, day) of buffered messages not
+        # covered by a commit yet, and a failed checkpoint
+        self._batch_db = None
+        self._batch_messages = []
+        self._batch_error = None
+        self._savepoint_seq = 0
         # Ensure the database directory exists and is writable
         db_dir = os.path.dirname(os.path.abspath(db_name))
         if not os.path.exists(db_dir):
@@ -17,6 +50,9 @@ class Database:
         try:
             self.logger.info(f"Initializing database at {os.path.abspath(self.db_name)}")
             async with aiosqlite.connect(self.db_name) as db:
+                # WAL lets long readers (such as exports) keep a snapshot without blocking writers
+                await db.execute('PRAGMA journal_mode=WAL')
+                
                 await db.execute('''
                     CREATE TABLE IF NOT EXISTS users (
                         telegram_id INTEGER PRIMARY KEY,
@@ -36,7 +72,116 @@ class Database:
                 except:
                     self.logger.info("has_chatted column already exists")
                 
+                # Add activity tracking columns to existing table if they don't exist
+                for column in ('message_count INTEGER DEFAULT 0', 'last_active TIMESTAMP'):
+                    try:
+                        await db.execute(f'ALTER TABLE users ADD COLUMN {column}')
+                        self.logger.info(f"Added {column.split()[0]} column to users table")
+                    except:
+                        self.logger.info(f"{column.split()[0]} column already exists")
+                
+                # Messages per user per UTC day, so activity thresholds can count a sliding window
+                await db.execute('''
+                    CREATE TABLE IF NOT EXISTS user_activity_daily (
+                        telegram_id INTEGER NOT NULL,
+                        day TEXT NOT NULL,
+                        messages INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (telegram_id, day)
+                    ) WITHOUT ROWID
+                ''')
+                await db.execute(
+                    'CREATE INDEX IF NOT EXISTS idx_activity_daily_day ON user_activity_daily (day)'
+                )
+                
+                # Referrals are counted per season; users record the season they joined in
+                try:
+                    await db.execute('ALTER TABLE users ADD COLUMN season_id INTEGER DEFAULT 1')
+                    self.logger.info("Added season_id column to users table")
+                except:
+                    self.logger.info("season_id column already exists")
+                
+                await db.execute('''
+                    CREATE TABLE IF NOT EXISTS seasons (
+                        season_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                await db.execute('INSERT OR IGNORE INTO seasons (season_id) VALUES (1)')
+                
+                # Standings of a season are frozen when it ends, so later rejoins and
+                # activity do not change past leaderboards
+                try:
+                    await db.execute('ALTER TABLE seasons ADD COLUMN ended_at TIMESTAMP')
+                    self.logger.info("Added ended_at column to seasons table")
+                except:
+                    self.logger.info("ended_at column already exists")
+                await db.execute('''
+                    CREATE TABLE IF NOT EXISTS season_leaderboard (
+                        season_id INTEGER NOT NULL,
+                        inviter_id INTEGER NOT NULL,
+                        referral_count INTEGER NOT NULL,
+                        PRIMARY KEY (season_id, inviter_id)
+                    ) WITHOUT ROWID
+                ''')
+                await db.execute(
+                    'CREATE INDEX IF NOT EXISTS idx_season_leaderboard_count '
+                    'ON season_leaderboard (season_id, referral_count)'
+                )
+                await db.execute(
+                    'CREATE INDEX IF NOT EXISTS idx_users_season_inviter ON users (season_id, inviter_id)'
+                )
+                
+                # Season the stored referrals counter belongs to; a counter from an older season reads as zero
+                try:
+                    await db.execute('ALTER TABLE users ADD COLUMN referrals_season INTEGER')
+                    self.logger.info("Added referrals_season column to users table")
+                except:
+                    self.logger.info("referrals_season column already exists")
+                
+                # Referral tree: every (ancestor, descendant) pair up to tree_max_depth levels apart,
+                # plus a per-user count of member descendants for the network leaderboard
+                try:
+                    await db.execute('ALTER TABLE users ADD COLUMN network_size INTEGER DEFAULT 0')
+                    self.logger.info("Added network_size column to users table")
+                except:
+                    self.logger.info("network_size column already exists")
+                
+                await db.execute('''
+                    CREATE TABLE IF NOT EXISTS referral_closure (
+                        ancestor_id INTEGER NOT NULL,
+                        descendant_id INTEGER NOT NULL,
+                        depth INTEGER NOT NULL,
+                        PRIMARY KEY (ancestor_id, depth, descendant_id)
+                    ) WITHOUT ROWID
+                ''')
+                await db.execute(
+                    'CREATE INDEX IF NOT EXISTS idx_closure_descendant ON referral_closure (descendant_id)'
+                )
+                await db.execute(
+                    'CREATE INDEX IF NOT EXISTS idx_users_network_size ON users (network_size)'
+                )
+                
                 await db.commit()
+                
+                await db.execute('''
+                    CREATE TABLE IF NOT EXISTS bot_state (
+                        key TEXT PRIMARY KEY,
+                        value TEXT
+                    )
+                ''')
+                await db.commit()
+                
+                async with db.execute('SELECT MAX(season_id) FROM seasons') as cursor:
+                    self.current_season = (await cursor.fetchone())[0]
+                self.logger.info(f"Current season: {self.current_season}")
+                
+                # Build the referral tree index once for databases created before it existed
+                async with db.execute('SELECT 1 FROM referral_closure LIMIT 1') as cursor:
+                    has_tree = await cursor.fetchone()
+                async with db.execute('SELECT 1 FROM users WHERE inviter_id IS NOT NULL LIMIT 1') as cursor:
+                    has_referrals = await cursor.fetchone()
+                if has_referrals and not has_tree:
+                    await self._rebuild_referral_tree(db)
                 self.logger.info("Database initialized successfully")
                 
                 # Verify table exists
@@ -48,10 +193,171 @@ class Database:
             self.logger.error(f"Error initializing database: {e}", exc_info=True)
             raise
 
+    @asynccontextmanager
+    async def _connect(self):
+        """Open a connection, or reuse the batch connection while a batch is open.
+
+        On the batch connection each call runs inside its own savepoint, so a
+        method that fails part-way only loses its own writes, exactly as when its
+        private connection is closed without committing outside a batch.
+        """
+        if self._batch_db is None:
+            async with aiosqlite.connect(self.db_name) as db:
+                yield db
+            return
+
+        db = self._batch_db
+        savepoint = None
+        if db.in_transaction:
+            self._savepoint_seq += 1
+            savepoint = f'batch_call_{self._savepoint_seq}'
+            await db.execute(f'SAVEPOINT {savepoint}')
+        try:
+            yield db
+        except BaseException:
+            if savepoint:
+                await db.execute(f'ROLLBACK TO {savepoint}')
+                await db.execute(f'RELEASE {savepoint}')
+            elif db.in_transaction:
+                # The transaction was started by this call, so it only holds this call's writes
+                await db.rollback()
+            raise
+        if savepoint:
+            await db.execute(f'RELEASE {savepoint}')
+
+    async def _commit(self, db):
+        """Commit, unless the connection belongs to an open batch (committed at its next checkpoint)"""
+        if db is not self._batch_db:
+            await db.commit()
+
+    async def checkpoint(self):
+        """Commit the writes made so far in the open batch.
+
+        Called before any network I/O so the write lock is only held across
+        consecutive database writes. A failed checkpoint fails the whole batch.
+        """
+        db = self._batch_db
+        if db is None:
+            return
+        if db.in_transaction:
+            try:
+                await db.commit()
+            except Exception as e:
+                self._batch_error = e
+                raise
+        self._batch_messages = []
+
+    def _undo_batch_messages(self):
+        """Take messages recorded since the last checkpoint back out of the activity buffer"""
+        for telegram_id, day in self._batch_messages:
+            entry = self._activity_buffer.get(telegram_id)
+            if entry:
+                entry[0] -= 1
+                entry[2][day] -= 1
+                if not entry[2][day]:
+                    del entry[2][day]
+                if entry[0] <= 0:
+                    del self._activity_buffer[telegram_id]
+        self._batch_messages = []
+
+    @asynccontextmanager
+    async def batch(self):
+        """Coalesce the writes made inside the block into as few transactions as possible.
+
+        Consecutive writes share one transaction, which is committed by
+        checkpoint() before any network I/O and when the block exits. If the
+        block raises (or a checkpoint failed), everything since the last
+        checkpoint is rolled back, including messages buffered in memory, so
+        callers can store progress (such as an update offset) next to the work
+        it covers. In-memory state (the current season and the membership index)
+        is updated as writes happen, so later updates in the batch see them, and
+        is reloaded from the database after a rollback.
+        """
+        async with aiosqlite.connect(self.db_name) as db:
+            self._batch_db = db
+            self._batch_messages = []
+            self._batch_error = None
+            try:
+                yield db
+                if self._batch_error is not None:
+                    raise self._batch_error
+                await self.checkpoint()
+            except BaseException:
+                await db.rollback()
+                self._undo_batch_messages()
+                # has_chatted writes may have been rolled back; let them be retried
+                self._chatted_seen.clear()
+                await self._reload_memory_state()
+                raise
+            finally:
+                self._batch_db = None
+                self._batch_error = None
+
+    async def _reload_memory_state(self):
+        """Re-read the current season and membership index after writes were rolled back"""
+        try:
+            async with aiosqlite.connect(self.db_name) as db:
+                async with db.execute('SELECT MAX(season_id) FROM seasons') as cursor:
+                    self.current_season = (await cursor.fetchone())[0]
+            if self.index is not None:
+                await self.load_membership_index()
+        except Exception as e:
+            # A stale index would give wrong answers; fall back to the database
+            self.index = None
+            self.logger.error(f"Error reloading in-memory state, membership index disabled: {e}", exc_info=True)
+
+    async def load_membership_index(self, chunk_size: int = 10000) -> MembershipIndex:
+        """Load the in-memory membership index; from then on it is kept up to date write-through"""
+        index = MembershipIndex(self.current_season)
+        async with aiosqlite.connect(self.db_name) as db:
+            async with db.execute(
+                'SELECT telegram_id, inviter_id, is_member, has_chatted, season_id FROM users ORDER BY telegram_id'
+            ) as cursor:
+                while True:
+                    rows = await cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    index.load_rows(rows)
+        index.finish_loading()
+        self.index = index
+        self.logger.info(f"Loaded membership index: {len(index)} users, {index.memory_bytes()} bytes")
+        return index
+
+    def _index_serves_active_referrals(self, season_id: int) -> bool:
+        """The index only tracks the default active definition in the current season"""
+        return (
+            self.index is not None
+            and (season_id is None or season_id == self.current_season)
+            and not self.active_min_messages
+            and not self.active_days
+        )
+
+    async def get_state(self, key: str) -> str:
+        """Get a value from the bot_state key/value table"""
+        try:
+            async with self._connect() as db:
+                async with db.execute('SELECT value FROM bot_state WHERE key = ?', (key,)) as cursor:
+                    result = await cursor.fetchone()
+                    return result[0] if result else None
+        except Exception as e:
+            self.logger.error(f"Error getting state {key}: {e}", exc_info=True)
+            return None
+
+    async def set_state(self, key: str, value: str):
+        """Store a value in the bot_state key/value table; errors propagate so callers can abort a batch"""
+        async with self._connect() as db:
+            await db.execute(
+                'INSERT INTO bot_state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                (key, str(value))
+            )
+            await self._commit(db)
+
     async def get_inviter(self, telegram_id: int) -> int:
         """Get the inviter ID for a user"""
+        if self.index is not None:
+            return self.index.get_inviter(telegram_id)
         try:
-            async with aiosqlite.connect(self.db_name) as db:
+            async with self._connect() as db:
                 async with db.execute(
                     'SELECT inviter_id FROM users WHERE telegram_id = ?',
                     (telegram_id,)
@@ -64,11 +370,14 @@ class Database:
 
     async def add_user(self, telegram_id: int, inviter_id: int = None) -> bool:
         """Add or update a user in the database"""
+        if self.index is not None and self.index.is_member(telegram_id):
+            # Already a member: nothing to write
+            return False
         try:
-            async with aiosqlite.connect(self.db_name) as db:
+            async with self._connect() as db:
                 # Check if user exists
                 async with db.execute(
-                    'SELECT telegram_id, inviter_id, is_member FROM users WHERE telegram_id = ?',
+                    'SELECT telegram_id, inviter_id, is_member, has_chatted FROM users WHERE telegram_id = ?',
                     (telegram_id,)
                 ) as cursor:
                     existing_user = await cursor.fetchone()
@@ -76,36 +385,47 @@ class Database:
                 if existing_user:
                     # User exists but was not a member
                     if not existing_user[2]:  # if not is_member
+                        # A rejoin counts as a referral in the season it happens in
                         await db.execute(
-                            'UPDATE users SET is_member = TRUE WHERE telegram_id = ?',
-                            (telegram_id,)
+                            'UPDATE users SET is_member = TRUE, season_id = ? WHERE telegram_id = ?',
+                            (self.current_season, telegram_id)
                         )
-                        if inviter_id:
-                            # Update inviter's referral count
-                            await db.execute(
-                                'UPDATE users SET referrals = referrals + 1 WHERE telegram_id = ?',
-                                (inviter_id,)
-                            )
-                            self.logger.info(f"Updated referral count for inviter {inviter_id}")
-                        await db.commit()
+                        await self._adjust_network_size(db, telegram_id, 1)
+                        if existing_user[1] and existing_user[3]:
+                            # A returning member who has chatted is an active referral again
+                            await self._adjust_referrals(db, existing_user[1], 1)
+                            self.logger.info(f"Updated referral count for inviter {existing_user[1]}")
+                        await self._commit(db)
+                        if self.index is not None:
+                            self.index.set_member(telegram_id, True, self.current_season)
                         return True
                     return False
                 
                 # Add new user
                 await db.execute(
-                    'INSERT INTO users (telegram_id, inviter_id, is_member, has_chatted) VALUES (?, ?, TRUE, FALSE)',
-                    (telegram_id, inviter_id)
+                    'INSERT INTO users (telegram_id, inviter_id, is_member, has_chatted, season_id) VALUES (?, ?, TRUE, FALSE, ?)',
+                    (telegram_id, inviter_id, self.current_season)
                 )
                 
-                # Update inviter's referral count
+                # The inviter's referral count only goes up once the new user chats
                 if inviter_id:
+                    # Link the new user below the inviter and all of the inviter's ancestors
                     await db.execute(
-                        'UPDATE users SET referrals = referrals + 1 WHERE telegram_id = ?',
-                        (inviter_id,)
+                        '''
+                        INSERT OR IGNORE INTO referral_closure (ancestor_id, descendant_id, depth)
+                        SELECT ?, ?, 1
+                        UNION ALL
+                        SELECT ancestor_id, ?, depth + 1
+                        FROM referral_closure
+                        WHERE descendant_id = ? AND depth < ?
+                        ''',
+                        (inviter_id, telegram_id, telegram_id, inviter_id, self.tree_max_depth)
                     )
-                    self.logger.info(f"Incremented referral count for inviter {inviter_id}")
+                    await self._adjust_network_size(db, telegram_id, 1)
                 
-                await db.commit()
+                await self._commit(db)
+                if self.index is not None:
+                    self.index.add(telegram_id, inviter_id, self.current_season)
                 return True
                 
         except Exception as e:
@@ -114,11 +434,14 @@ class Database:
 
     async def remove_user(self, telegram_id: int) -> bool:
         """Mark a user as not a member and update referral counts"""
+        if self.index is not None and not self.index.is_member(telegram_id):
+            # Unknown or already marked as not a member
+            return False
         try:
-            async with aiosqlite.connect(self.db_name) as db:
+            async with self._connect() as db:
                 # Get user's current status and inviter
                 async with db.execute(
-                    'SELECT is_member, inviter_id FROM users WHERE telegram_id = ?',
+                    'SELECT is_member, inviter_id, has_chatted, season_id FROM users WHERE telegram_id = ?',
                     (telegram_id,)
                 ) as cursor:
                     user_data = await cursor.fetchone()
@@ -126,7 +449,7 @@ class Database:
                     if not user_data:
                         return False
                     
-                    is_member, inviter_id = user_data
+                    is_member, inviter_id, has_chatted, season_id = user_data
                     
                     if not is_member:  # Already marked as not a member
                         return False
@@ -136,29 +459,95 @@ class Database:
                     'UPDATE users SET is_member = FALSE WHERE telegram_id = ?',
                     (telegram_id,)
                 )
+                await self._adjust_network_size(db, telegram_id, -1)
                 
-                # Decrease inviter's referral count if exists
-                if inviter_id:
-                    await db.execute(
-                        'UPDATE users SET referrals = CASE WHEN referrals > 0 THEN referrals - 1 ELSE 0 END WHERE telegram_id = ?',
-                        (inviter_id,)
-                    )
+                # Decrease inviter's referral count if this was an active referral this season
+                if inviter_id and has_chatted and season_id == self.current_season:
+                    await self._adjust_referrals(db, inviter_id, -1)
                     self.logger.info(f"Decremented referral count for inviter {inviter_id}")
                 
-                await db.commit()
+                await self._commit(db)
+                if self.index is not None:
+                    self.index.set_member(telegram_id, False)
                 return True
                 
         except Exception as e:
             self.logger.error(f"Error removing user: {e}", exc_info=True)
             return False
 
-    async def get_total_referrals(self, telegram_id: int) -> int:
-        """Get total number of users referred by a user"""
+    @staticmethod
+    def _stored_referrals(alias: str = None) -> str:
+        """SQL for the stored referrals counter, read as zero when it was last written in an earlier season"""
+        prefix = f'{alias}.' if alias else ''
+        return f'CASE WHEN {prefix}referrals_season = ? THEN COALESCE({prefix}referrals, 0) ELSE 0 END'
+
+    async def _adjust_referrals(self, db, inviter_id: int, delta: int):
+        """Add delta to an inviter's stored referrals counter for the current season"""
+        await db.execute(
+            f'''
+            UPDATE users
+            SET referrals = MAX({self._stored_referrals()} + ?, 0),
+                referrals_season = ?
+            WHERE telegram_id = ?
+            ''',
+            (self.current_season, delta, self.current_season, inviter_id)
+        )
+
+    async def _adjust_network_size(self, db, telegram_id: int, delta: int):
+        """Add delta to the network size of every ancestor of a user"""
+        await db.execute(
+            '''
+            UPDATE users
+            SET network_size = MAX(COALESCE(network_size, 0) + ?, 0)
+            WHERE telegram_id IN (
+                SELECT ancestor_id FROM referral_closure WHERE descendant_id = ?
+            )
+            ''',
+            (delta, telegram_id)
+        )
+
+    async def _rebuild_referral_tree(self, db):
+        """Recompute the closure table and network sizes from users.inviter_id"""
+        self.logger.info("Rebuilding referral tree index")
+        await db.execute('DELETE FROM referral_closure')
+        await db.execute(
+            '''
+            INSERT OR IGNORE INTO referral_closure (ancestor_id, descendant_id, depth)
+            WITH RECURSIVE tree (ancestor_id, descendant_id, depth) AS (
+                SELECT inviter_id, telegram_id, 1
+                FROM users
+                WHERE inviter_id IS NOT NULL
+                UNION
+                SELECT u.inviter_id, t.descendant_id, t.depth + 1
+                FROM tree t
+                JOIN users u ON u.telegram_id = t.ancestor_id
+                WHERE u.inviter_id IS NOT NULL AND t.depth < ?
+            )
+            SELECT ancestor_id, descendant_id, depth FROM tree
+            ''',
+            (self.tree_max_depth,)
+        )
+        await db.execute(
+            '''
+            UPDATE users SET network_size = (
+                SELECT COUNT(*)
+                FROM referral_closure c
+                JOIN users d ON d.telegram_id = c.descendant_id
+                WHERE c.ancestor_id = users.telegram_id
+                AND d.is_member = TRUE
+            )
+            '''
+        )
+        await db.commit()
+        self.logger.info("Referral tree index rebuilt")
+
+    async def get_total_referrals(self, telegram_id: int, season_id: int = None) -> int:
+        """Get total number of users referred by a user in a season (current season by default)"""
         try:
-            async with aiosqlite.connect(self.db_name) as db:
+            async with self._connect() as db:
                 async with db.execute(
-                    'SELECT COUNT(*) FROM users WHERE inviter_id = ?',
-                    (telegram_id,)
+                    'SELECT COUNT(*) FROM users WHERE season_id = ? AND inviter_id = ?',
+                    (season_id or self.current_season, telegram_id)
                 ) as cursor:
                     result = await cursor.fetchone()
                     count = result[0] if result else 0
@@ -168,19 +557,52 @@ class Database:
             self.logger.error(f"Error getting total referrals: {e}", exc_info=True)
             return 0
 
-    async def get_active_referrals(self, telegram_id: int) -> int:
-        """Get number of active referrals (who have chatted) for a user"""
+    def _active_referral_filter(self, alias: str, include_activity: bool = True) -> tuple:
+        """Build the SQL condition (and its parameters) that makes a referred user count as active.
+
+        With include_activity False the activity thresholds are left out; that is
+        the definition the stored referrals counter is maintained for. With both
+        thresholds set, messages are summed over the last active_days UTC days
+        (today included) from the daily counters.
+        """
+        conditions = [f'{alias}.is_member = TRUE', f'{alias}.has_chatted = TRUE']
+        params = []
+        if not include_activity:
+            return ' AND '.join(conditions), params
+        if self.active_min_messages and self.active_days:
+            conditions.append(f'''(
+                SELECT COALESCE(SUM(a.messages), 0) FROM user_activity_daily a
+                WHERE a.telegram_id = {alias}.telegram_id AND a.day > date('now', ?)
+            ) >= ?''')
+            params.extend((f'-{self.active_days} days', self.active_min_messages))
+        elif self.active_min_messages:
+            conditions.append(f'{alias}.message_count >= ?')
+            params.append(self.active_min_messages)
+        elif self.active_days:
+            conditions.append(f"{alias}.last_active >= datetime('now', ?)")
+            params.append(f'-{self.active_days} days')
+        return ' AND '.join(conditions), params
+
+    async def get_active_referrals(self, telegram_id: int, season_id: int = None) -> int:
+        """Get number of active referrals (who have chatted) for a user in a season (current season by default)"""
+        if self._index_serves_active_referrals(season_id):
+            return self.index.active_referrals(telegram_id)
         try:
-            async with aiosqlite.connect(self.db_name) as db:
+            # Make buffered activity visible to the activity thresholds; without thresholds
+            # nothing read here depends on it, so skip the write
+            if self.active_min_messages or self.active_days:
+                await self.flush_activity()
+            active_filter, active_params = self._active_referral_filter('r')
+            async with self._connect() as db:
                 async with db.execute(
-                    '''
+                    f'''
                     SELECT COUNT(*) 
-                    FROM users 
-                    WHERE inviter_id = ? 
-                    AND is_member = TRUE 
-                    AND has_chatted = TRUE
+                    FROM users r
+                    WHERE r.season_id = ?
+                    AND r.inviter_id = ? 
+                    AND {active_filter}
                     ''',
-                    (telegram_id,)
+                    (season_id or self.current_season, telegram_id, *active_params)
                 ) as cursor:
                     result = await cursor.fetchone()
                     count = result[0] if result else 0
@@ -192,18 +614,25 @@ class Database:
 
     async def mark_user_chatted(self, telegram_id: int) -> bool:
         """Mark a user as having chatted and update inviter's referral count if needed"""
+        if self.index is not None:
+            if self.index.has_chatted(telegram_id):
+                self._chatted_seen.add(telegram_id)
+                return False
+            if not self.index.contains(telegram_id):
+                return False
         try:
-            async with aiosqlite.connect(self.db_name) as db:
+            async with self._connect() as db:
                 # Get user's current status and inviter
                 async with db.execute(
-                    'SELECT has_chatted, inviter_id FROM users WHERE telegram_id = ?',
+                    'SELECT has_chatted, inviter_id, is_member, season_id FROM users WHERE telegram_id = ?',
                     (telegram_id,)
                 ) as cursor:
                     result = await cursor.fetchone()
                     if not result:
                         return False
                     
-                    has_chatted, inviter_id = result
+                    has_chatted, inviter_id, is_member, season_id = result
+                    self._chatted_seen.add(telegram_id)
                     
                     # If user hasn't chatted before
                     if not has_chatted:
@@ -213,15 +642,14 @@ class Database:
                             (telegram_id,)
                         )
                         
-                        # If they have an inviter, increment their referral count
-                        if inviter_id:
-                            await db.execute(
-                                'UPDATE users SET referrals = referrals + 1 WHERE telegram_id = ?',
-                                (inviter_id,)
-                            )
+                        # If they are a referral in the current season, increment the inviter's count
+                        if inviter_id and is_member and season_id == self.current_season:
+                            await self._adjust_referrals(db, inviter_id, 1)
                             self.logger.info(f"Incremented referral count for inviter {inviter_id} after user {telegram_id} chatted")
                         
-                        await db.commit()
+                        await self._commit(db)
+                        if self.index is not None:
+                            self.index.set_chatted(telegram_id)
                         return True
                     
                     return False
@@ -230,24 +658,225 @@ class Database:
             self.logger.error(f"Error marking user as chatted: {e}", exc_info=True)
             return False
 
-    async def get_leaderboard(self, limit: int = 10) -> list:
-        """Get top inviters with active chatting referrals"""
+    def record_message(self, telegram_id: int) -> bool:
+        """Buffer a message from a user in memory.
+
+        Returns True until the user is known to have has_chatted set, so the
+        caller knows when mark_user_chatted may still need to run.
+        """
+        now = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        day = now[:10]
+        entry = self._activity_buffer.get(telegram_id)
+        if entry:
+            entry[0] += 1
+            entry[1] = now
+            entry[2][day] = entry[2].get(day, 0) + 1
+        else:
+            self._activity_buffer[telegram_id] = [1, now, {day: 1}]
+        if self._batch_db is not None:
+            self._batch_messages.append((telegram_id, day))
+
+        return telegram_id not in self._chatted_seen
+
+    async def flush_activity(self) -> int:
+        """Write buffered message counters to the database in a single batch"""
+        async with self._activity_lock:
+            # A separate writer would wait on the batch's write lock; flush after the batch instead
+            if not self._activity_buffer or self._batch_db is not None:
+                return 0
+
+            # Swap the buffer out so new messages keep accumulating while we write
+            pending, self._activity_buffer = self._activity_buffer, {}
+            committed = False
+            try:
+                async with aiosqlite.connect(self.db_name) as db:
+                    await db.executemany(
+                        '''
+                        UPDATE users
+                        SET message_count = COALESCE(message_count, 0) + ?,
+                            last_active = MAX(COALESCE(last_active, ''), ?)
+                        WHERE telegram_id = ?
+                        ''',
+                        [(count, last_seen, telegram_id) for telegram_id, (count, last_seen, _) in pending.items()]
+                    )
+                    # Daily counters only back the windowed threshold and are kept for that window only
+                    if self.active_min_messages and self.active_days:
+                        await db.executemany(
+                            '''
+                            INSERT INTO user_activity_daily (telegram_id, day, messages) VALUES (?, ?, ?)
+                            ON CONFLICT (telegram_id, day) DO UPDATE SET messages = messages + excluded.messages
+                            ''',
+                            [
+                                (telegram_id, day, messages)
+                                for telegram_id, (_, _, days) in pending.items()
+                                for day, messages in days.items()
+                            ]
+                        )
+                        await db.execute(
+                            "DELETE FROM user_activity_daily WHERE day <= date('now', ?)",
+                            (f'-{self.active_days} days',)
+                        )
+                    await db.commit()
+                    committed = True
+                self.logger.info(f"Flushed activity for {len(pending)} users")
+                return len(pending)
+            except BaseException as e:
+                # Merge the batch back so nothing is lost (also when the flush task is cancelled
+                # mid-write at shutdown); the next flush retries it
+                if not committed:
+                    for telegram_id, (count, last_seen, days) in pending.items():
+                        entry = self._activity_buffer.get(telegram_id)
+                        if entry:
+                            entry[0] += count
+                            entry[1] = max(entry[1], last_seen)
+                            for day, messages in days.items():
+                                entry[2][day] = entry[2].get(day, 0) + messages
+                        else:
+                            self._activity_buffer[telegram_id] = [count, last_seen, days]
+                if not isinstance(e, Exception):
+                    raise
+                self.logger.error(f"Error flushing activity: {e}", exc_info=True)
+                return 0
+
+    async def get_user_activity(self, telegram_id: int) -> tuple:
+        """Get (message_count, last_active) for a user, including buffered activity"""
+        message_count, last_active = 0, None
         try:
+            async with self._connect() as db:
+                async with db.execute(
+                    'SELECT message_count, last_active FROM users WHERE telegram_id = ?',
+                    (telegram_id,)
+                ) as cursor:
+                    result = await cursor.fetchone()
+                    if result:
+                        message_count, last_active = result[0] or 0, result[1]
+        except Exception as e:
+            self.logger.error(f"Error getting user activity: {e}", exc_info=True)
+
+        entry = self._activity_buffer.get(telegram_id)
+        if entry:
+            message_count += entry[0]
+            last_active = max(last_active or '', entry[1])
+        return message_count, last_active
+
+    async def reconcile_referrals_chunk(self, after_id: int = 0, chunk_size: int = 500) -> dict:
+        """Recompute the stored referrals counter for the next chunk of users.
+
+        Users are visited in telegram_id order starting after `after_id`. The true
+        count is the number of current-season referrals who are members and have
+        chatted, which is what add_user, remove_user and mark_user_chatted keep
+        the counter at (activity thresholds are time-dependent and not stored). Each
+        chunk is read outside a transaction and repaired in one short write
+        transaction, and a row is only overwritten if its counter has not changed
+        since it was read. The cursor is stored with the repairs so a pass can
+        resume after a restart. Returns the chunk's drift metrics, with
+        last_id None once the pass has reached the end of the table, or None on error.
+        """
+        try:
+            active_filter, active_params = self._active_referral_filter('r', include_activity=False)
+            season_id = self.current_season
+            # Use a dedicated connection so this never joins a batch transaction
             async with aiosqlite.connect(self.db_name) as db:
                 async with db.execute(
-                    '''
-                    SELECT u.telegram_id, COUNT(r.telegram_id) as referral_count
+                    f'''
+                    SELECT u.telegram_id,
+                        {self._stored_referrals('u')},
+                        (
+                            SELECT COUNT(*)
+                            FROM users r
+                            WHERE r.season_id = ?
+                            AND r.inviter_id = u.telegram_id
+                            AND {active_filter}
+                        )
                     FROM users u
-                    LEFT JOIN users r ON r.inviter_id = u.telegram_id 
-                        AND r.is_member = TRUE 
-                        AND r.has_chatted = TRUE
-                    WHERE u.is_member = TRUE
-                    GROUP BY u.telegram_id
-                    HAVING referral_count > 0
-                    ORDER BY referral_count DESC
+                    WHERE u.telegram_id > ?
+                    ORDER BY u.telegram_id
                     LIMIT ?
                     ''',
-                    (limit,)
+                    (season_id, season_id, *active_params, after_id, chunk_size)
+                ) as cursor:
+                    rows = await cursor.fetchall()
+
+                divergent = [(true_count, telegram_id, stored) for telegram_id, stored, true_count in rows if stored != true_count]
+                changes_before = db.total_changes
+                if divergent:
+                    await db.executemany(
+                        f'''
+                        UPDATE users SET referrals = ?, referrals_season = ?
+                        WHERE telegram_id = ? AND {self._stored_referrals()} = ?
+                        ''',
+                        [(true_count, season_id, telegram_id, season_id, stored) for true_count, telegram_id, stored in divergent]
+                    )
+                repaired = db.total_changes - changes_before
+
+                last_id = rows[-1][0] if len(rows) == chunk_size else None
+                await db.execute(
+                    'INSERT INTO bot_state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                    ('reconcile_cursor', '' if last_id is None else str(last_id))
+                )
+                await db.commit()
+
+            return {
+                'last_id': last_id,
+                'scanned': len(rows),
+                'divergent': len(divergent),
+                'repaired': repaired,
+                'drift': sum(abs(stored - true_count) for true_count, _, stored in divergent),
+                'max_drift': max((abs(stored - true_count) for true_count, _, stored in divergent), default=0),
+            }
+        except Exception as e:
+            self.logger.error(f"Error reconciling referrals after {after_id}: {e}", exc_info=True)
+            return None
+
+    def _standings_query(self) -> tuple:
+        """SQL (and parameters after the season id) counting active referrals per member inviter in a season"""
+        active_filter, active_params = self._active_referral_filter('r')
+        sql = f'''
+            SELECT r.inviter_id, COUNT(*) as referral_count
+            FROM users r
+            JOIN users u ON u.telegram_id = r.inviter_id
+                AND u.is_member = TRUE
+            WHERE r.season_id = ?
+            AND {active_filter}
+            GROUP BY r.inviter_id
+        '''
+        return sql, active_params
+
+    async def get_leaderboard(self, limit: int = 10, season_id: int = None) -> list:
+        """Get top inviters with active chatting referrals in a season (current season by default).
+
+        Seasons that ended after standings were frozen are read from
+        season_leaderboard; the current season is counted live.
+        """
+        season_id = season_id or self.current_season
+        try:
+            async with self._connect() as db:
+                if season_id != self.current_season:
+                    async with db.execute('SELECT ended_at FROM seasons WHERE season_id = ?', (season_id,)) as cursor:
+                        season = await cursor.fetchone()
+                    if season and season[0]:
+                        async with db.execute(
+                            '''
+                            SELECT inviter_id, referral_count FROM season_leaderboard
+                            WHERE season_id = ?
+                            ORDER BY referral_count DESC
+                            LIMIT ?
+                            ''',
+                            (season_id, limit)
+                        ) as cursor:
+                            result = await cursor.fetchall()
+                            self.logger.info(f"Retrieved frozen leaderboard of season {season_id} with {len(result)} entries")
+                            return result
+            
+            # Make buffered activity visible to the activity thresholds; without thresholds
+            # nothing read here depends on it, so skip the write
+            if self.active_min_messages or self.active_days:
+                await self.flush_activity()
+            standings_sql, standings_params = self._standings_query()
+            async with self._connect() as db:
+                async with db.execute(
+                    f'{standings_sql} ORDER BY referral_count DESC LIMIT ?',
+                    (season_id, *standings_params, limit)
                 ) as cursor:
                     result = await cursor.fetchall()
                     self.logger.info(f"Retrieved leaderboard with {len(result)} entries")
@@ -256,14 +885,152 @@ class Database:
             self.logger.error(f"Error getting leaderboard: {e}", exc_info=True)
             return []
 
+    async def get_tree_counts(self, telegram_id: int, max_depth: int = 3) -> list:
+        """Get (depth, member count) for each level of a user's referral tree, all seasons"""
+        try:
+            async with self._connect() as db:
+                async with db.execute(
+                    '''
+                    SELECT c.depth, COUNT(*)
+                    FROM referral_closure c
+                    JOIN users d ON d.telegram_id = c.descendant_id
+                        AND d.is_member = TRUE
+                    WHERE c.ancestor_id = ? AND c.depth <= ?
+                    GROUP BY c.depth
+                    ORDER BY c.depth
+                    ''',
+                    (telegram_id, max_depth)
+                ) as cursor:
+                    return await cursor.fetchall()
+        except Exception as e:
+            self.logger.error(f"Error getting referral tree: {e}", exc_info=True)
+            return []
+
+    async def get_network_size(self, telegram_id: int) -> int:
+        """Get the number of members anywhere below a user in the referral tree"""
+        try:
+            async with self._connect() as db:
+                async with db.execute(
+                    'SELECT network_size FROM users WHERE telegram_id = ?',
+                    (telegram_id,)
+                ) as cursor:
+                    result = await cursor.fetchone()
+                    return (result[0] or 0) if result else 0
+        except Exception as e:
+            self.logger.error(f"Error getting network size: {e}", exc_info=True)
+            return 0
+
+    async def get_network_leaderboard(self, limit: int = 10) -> list:
+        """Get top users by total network size (referrals of referrals included)"""
+        try:
+            async with self._connect() as db:
+                async with db.execute(
+                    '''
+                    SELECT telegram_id, network_size
+                    FROM users
+                    WHERE network_size > 0 AND is_member = TRUE
+                    ORDER BY network_size DESC
+                    LIMIT ?
+                    ''',
+                    (limit,)
+                ) as cursor:
+                    result = await cursor.fetchall()
+                    self.logger.info(f"Retrieved network leaderboard with {len(result)} entries")
+                    return result
+        except Exception as e:
+            self.logger.error(f"Error getting network leaderboard: {e}", exc_info=True)
+            return []
+
+    async def iter_export_rows(self, chunk_size: int = 1000):
+        """Yield chunks of export rows (see EXPORT_COLUMNS) from one consistent snapshot.
+
+        Rows are read through a cursor inside a single read transaction on a
+        dedicated connection, so memory stays flat and writers are not blocked.
+        Referral counts are for the current season; errors propagate to the caller.
+        """
+        # Persist buffered activity so the snapshot includes it
+        await self.flush_activity()
+        active_filter, active_params = self._active_referral_filter('r')
+        async with aiosqlite.connect(self.db_name) as db:
+            await db.execute('BEGIN')
+            try:
+                async with db.execute(
+                    f'''
+                    SELECT u.telegram_id, u.inviter_id, u.is_member, u.has_chatted, u.join_date, u.season_id,
+                        COALESCE(u.message_count, 0), u.last_active,
+                        {self._stored_referrals('u')},
+                        (
+                            SELECT COUNT(*) FROM users r
+                            WHERE r.season_id = ? AND r.inviter_id = u.telegram_id
+                        ),
+                        (
+                            SELECT COUNT(*) FROM users r
+                            WHERE r.season_id = ? AND r.inviter_id = u.telegram_id AND {active_filter}
+                        ),
+                        COALESCE(u.network_size, 0)
+                    FROM users u
+                    ORDER BY u.telegram_id
+                    ''',
+                    (self.current_season, self.current_season, self.current_season, *active_params)
+                ) as cursor:
+                    while True:
+                        rows = await cursor.fetchmany(chunk_size)
+                        if not rows:
+                            break
+                        yield rows
+            finally:
+                await db.rollback()
+
     async def clear_all_referrals(self) -> bool:
-        """Reset all referral counts to zero"""
+        """Reset the leaderboard by starting a new season.
+
+        The ending season's standings are copied to season_leaderboard (one row
+        per inviter with active referrals) and a season row is inserted; no user
+        row is touched.
+        """
+        season_id = await self.start_new_season()
+        return season_id is not None
+
+    async def start_new_season(self) -> int:
+        """Freeze the standings of the current season, start a new one and return its id"""
         try:
-            async with aiosqlite.connect(self.db_name) as db:
-                await db.execute('UPDATE users SET referrals = 0')
-                await db.commit()
-                self.logger.info("All referral counts reset to zero")
-                return True
+            if self.active_min_messages or self.active_days:
+                await self.flush_activity()
+            standings_sql, standings_params = self._standings_query()
+            async with self._connect() as db:
+                ending_season = self.current_season
+                await db.execute(
+                    f'INSERT OR REPLACE INTO season_leaderboard (inviter_id, referral_count, season_id) '
+                    f'SELECT inviter_id, referral_count, ? FROM ({standings_sql})',
+                    (ending_season, ending_season, *standings_params)
+                )
+                await db.execute(
+                    'UPDATE seasons SET ended_at = CURRENT_TIMESTAMP WHERE season_id = ?',
+                    (ending_season,)
+                )
+                cursor = await db.execute('INSERT INTO seasons DEFAULT VALUES')
+                season_id = cursor.lastrowid
+                await self._commit(db)
+                self._set_current_season(season_id)
+                self.logger.info(f"Started season {season_id}")
+                return season_id
         except Exception as e:
-            self.logger.error(f"Error clearing referrals: {e}", exc_info=True)
-            return False
+            self.logger.error(f"Error starting new season: {e}", exc_info=True)
+            return None
+
+    def _set_current_season(self, season_id: int):
+        self.current_season = season_id
+        if self.index is not None:
+            self.index.start_season(season_id)
+
+    async def get_seasons(self) -> list:
+        """Get all seasons as (season_id, started_at), newest first"""
+        try:
+            async with self._connect() as db:
+                async with db.execute(
+                    'SELECT season_id, started_at FROM seasons ORDER BY season_id DESC'
+                ) as cursor:
+                    return await cursor.fetchall()
+        except Exception as e:
+            self.logger.error(f"Error getting seasons: {e}", exc_info=True)
+            return []
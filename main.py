@@ -1,7 +1,16 @@
 import logging
+import asyncio
+import csv
+import hmac
+import io
+import json
+import signal
+import tempfile
 from telegram import Update, BotCommand
 from telegram.ext import Application, CommandHandler, ContextTypes, ChatMemberHandler, filters, MessageHandler
+from telegram.request import HTTPXRequest
 from database import Database
+from admission import AdmissionController
 import time
 import os
 from aiohttp import web
@@ -14,8 +23,22 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Active referral thresholds: at least N messages within the last M days (0 / unset disables)
+ACTIVE_MIN_MESSAGES = int(os.environ.get('ACTIVE_MIN_MESSAGES', '0'))
+ACTIVE_DAYS = int(os.environ.get('ACTIVE_DAYS', '0')) or None
+
+# How often buffered message counters are written to the database (seconds)
+ACTIVITY_FLUSH_INTERVAL = int(os.environ.get('ACTIVITY_FLUSH_INTERVAL', '30'))
+
+# Referral tree: levels kept in the index, and levels shown by /mytree
+TREE_MAX_DEPTH = int(os.environ.get('TREE_MAX_DEPTH', '10'))
+TREE_DISPLAY_DEPTH = int(os.environ.get('TREE_DISPLAY_DEPTH', '3'))
+
+# Keep membership state in a compact in-memory index so hot reads skip SQLite
+MEMORY_INDEX = os.environ.get('MEMORY_INDEX', 'false').lower() in ('1', 'true', 'yes')
+
 # Initialize database
-db = Database()
+db = Database(active_min_messages=ACTIVE_MIN_MESSAGES, active_days=ACTIVE_DAYS, tree_max_depth=TREE_MAX_DEPTH)
 
 # Your group ID (make sure it starts with -100 for supergroups)
 GROUP_ID = int(os.environ.get('GROUP_ID', '-1002384613497'))
@@ -27,6 +50,22 @@ ADMIN_ID = int(os.environ.get('ADMIN_ID', '5044951913'))  # Replace with your Te
 DOMAIN = os.environ.get('DOMAIN', 'bot.patoonsol.xyz').rstrip('/')  # Your Cloudflare domain
 WEBHOOK_PATH = '/webhook'
 WEBHOOK_URL = f"https://{DOMAIN}{WEBHOOK_PATH}"
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', 'your-secret-token')
+
+# Admin export over HTTP, protected by WEBHOOK_SECRET; disabled unless it is set explicitly
+EXPORT_PATH = '/export'
+EXPORT_ENABLED = bool(os.environ.get('WEBHOOK_SECRET'))
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+# Update delivery: 'webhook' (default) or 'polling' for running without a public domain
+BOT_MODE = os.environ.get('BOT_MODE', 'webhook').lower()
+
+# Polling settings: updates fetched per getUpdates call and long-poll timeout (seconds)
+POLL_BATCH_SIZE = int(os.environ.get('POLL_BATCH_SIZE', '100'))
+POLL_TIMEOUT = int(os.environ.get('POLL_TIMEOUT', '30'))
+
+# Update types the bot subscribes to
+ALLOWED_UPDATES = ['message', 'chat_member', 'callback_query']
 
 # Port is given by Render
 PORT = int(os.environ.get('PORT', '8080'))
@@ -34,6 +73,25 @@ PORT = int(os.environ.get('PORT', '8080'))
 # Telegram Bot Token
 TOKEN = os.environ.get('BOT_TOKEN', '7790381038:AAE26s1oHYvlZX2wyY_cW7VsjJmNaxXFlYc')
 
+# Referral counter reconciliation: users per chunk, pause between chunks and between full passes (seconds)
+RECONCILE_CHUNK_SIZE = int(os.environ.get('RECONCILE_CHUNK_SIZE', '500'))
+RECONCILE_CHUNK_DELAY = float(os.environ.get('RECONCILE_CHUNK_DELAY', '0.5'))
+RECONCILE_PASS_INTERVAL = int(os.environ.get('RECONCILE_PASS_INTERVAL', '3600'))
+
+# Command admission control: token buckets per user and per chat (tokens per second / burst size),
+# and load shedding once this many updates are in flight or queued
+admission = AdmissionController(
+    user_rate=float(os.environ.get('THROTTLE_USER_RATE', '0.2')),
+    user_burst=float(os.environ.get('THROTTLE_USER_BURST', '3')),
+    chat_rate=float(os.environ.get('THROTTLE_CHAT_RATE', '1')),
+    chat_burst=float(os.environ.get('THROTTLE_CHAT_BURST', '10')),
+    max_backlog=int(os.environ.get('THROTTLE_MAX_BACKLOG', '50')),
+    exempt_user_ids=(ADMIN_ID,)
+)
+
+# How often throttle counters are written to the log (seconds)
+THROTTLE_REPORT_INTERVAL = int(os.environ.get('THROTTLE_REPORT_INTERVAL', '300'))
+
 async def track_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Track when users join or leave the group"""
     try:
@@ -194,7 +252,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "📊 <b>Available Commands:</b>\n"
                 "👉 /start - Get a new invite link\n"
                 "👉 /leaderboard - View top inviters\n"
-                "👉 /myreferrals - Check your referral count\n\n"
+                "👉 /myreferrals - Check your referral count\n"
+                "👉 /mytree - See your whole referral network\n\n"
                 "✨ <i>You'll get notified when someone joins using your link!</i>"
             )
             
@@ -229,17 +288,25 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show top 10 inviters"""
+    """Show top 10 inviters, optionally for a past season (/leaderboard <season>)"""
     try:
         logger.info(f"Leaderboard command received from user {update.effective_user.id} in chat {update.effective_chat.id}")
         
-        top_inviters = await db.get_leaderboard(limit=10)  # Explicitly set limit to 10
+        season_id = db.current_season
+        if context.args:
+            try:
+                season_id = int(context.args[0])
+            except ValueError:
+                await update.message.reply_text("❌ Usage: /leaderboard [season number]")
+                return
+        
+        top_inviters = await db.get_leaderboard(limit=10, season_id=season_id)  # Explicitly set limit to 10
         
         if not top_inviters:
-            await update.message.reply_text("🏆 No referrals yet! Be the first to invite someone! 🎯")
+            await update.message.reply_text(f"🏆 No referrals in season {season_id} yet! Be the first to invite someone! 🎯")
             return
 
-        leaderboard_text = "🏆 <b>Top 10 Inviters</b> 🏆\n\n"
+        leaderboard_text = f"🏆 <b>Top 10 Inviters — Season {season_id}</b> 🏆\n\n"
         for rank, (user_id, referrals) in enumerate(top_inviters, 1):
             # Special medals for top 3
             medal = {
@@ -286,11 +353,13 @@ async def my_referrals(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         total_refs = await db.get_total_referrals(user_id)
         active_refs = await db.get_active_referrals(user_id)
+        message_count, _ = await db.get_user_activity(user_id)
         
         stats_text = (
-            "📊 <b>Your Referral Stats</b>\n\n"
+            f"📊 <b>Your Referral Stats — Season {db.current_season}</b>\n\n"
             f"👥 Total Referrals: {total_refs}\n"
-            f"✅ Active Referrals: {active_refs}\n\n"
+            f"✅ Active Referrals: {active_refs}\n"
+            f"💬 Your Messages: {message_count}\n\n"
             "Use /start to get a new invite link!"
         )
         
@@ -300,6 +369,69 @@ async def my_referrals(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error showing referral stats: {e}", exc_info=True)
         await update.message.reply_text("❌ Error fetching your stats. Please try again later.")
 
+async def my_tree(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show how many members a user brought in at each level of their referral tree"""
+    try:
+        user_id = update.effective_user.id
+        logger.info(f"My tree command received from user {user_id} in chat {update.effective_chat.id}")
+        
+        levels = await db.get_tree_counts(user_id, max_depth=TREE_DISPLAY_DEPTH)
+        network_size = await db.get_network_size(user_id)
+        
+        if not levels:
+            await update.message.reply_text("🌱 Your referral tree is empty. Use /start to get your invite link!")
+            return
+        
+        tree_text = "🌳 <b>Your Referral Tree</b>\n\n"
+        for depth, count in levels:
+            label = "Direct referrals" if depth == 1 else f"Level {depth}"
+            tree_text += f"{'└' * depth} {label}: {count}\n"
+        tree_text += f"\n👥 Total network size: {network_size}"
+        
+        await update.message.reply_text(tree_text, parse_mode='HTML')
+        logger.info(f"Tree displayed for user {user_id}")
+    except Exception as e:
+        logger.error(f"Error showing referral tree: {e}", exc_info=True)
+        await update.message.reply_text("❌ Error fetching your referral tree. Please try again later.")
+
+async def top_networks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show top 10 users by total network size"""
+    try:
+        logger.info(f"Top networks command received from user {update.effective_user.id} in chat {update.effective_chat.id}")
+        
+        top_users = await db.get_network_leaderboard(limit=10)
+        
+        if not top_users:
+            await update.message.reply_text("🌳 No referral networks yet! Be the first to invite someone! 🎯")
+            return
+        
+        networks_text = "🌳 <b>Top 10 Networks</b> 🌳\n\n"
+        for rank, (user_id, network_size) in enumerate(top_users, 1):
+            medal = {
+                1: "🥇", 
+                2: "🥈", 
+                3: "🥉"
+            }.get(rank, f"{rank}.")
+            
+            try:
+                user = await context.bot.get_chat(user_id)
+                name = user.username or user.first_name or str(user_id)
+                name = f"@{name}" if user.username else name
+                networks_text += f"{medal} {name}\n└ {network_size} members in network\n\n"
+            except Exception as e:
+                logger.error(f"Error getting user info for {user_id}: {e}")
+                networks_text += f"{medal} User {user_id}: {network_size} members in network\n\n"
+        
+        await update.message.reply_text(
+            networks_text,
+            parse_mode='HTML',
+            disable_web_page_preview=True
+        )
+        logger.info("Network leaderboard displayed successfully")
+    except Exception as e:
+        logger.error(f"Error showing network leaderboard: {e}", exc_info=True)
+        await update.message.reply_text("❌ Error fetching network leaderboard. Please try again later.")
+
 async def clear_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command to clear all referral counts"""
     try:
@@ -315,8 +447,8 @@ async def clear_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Ask for confirmation
         confirmation_text = (
             "⚠️ <b>Warning!</b> ⚠️\n\n"
-            "This will reset ALL referral counts to zero.\n"
-            "This action cannot be undone.\n\n"
+            "This will end the current season and reset ALL referral counts to zero.\n"
+            "Past seasons stay available via /leaderboard &lt;season&gt;.\n\n"
             "Are you sure? Reply with /confirmclear to proceed."
         )
         context.user_data['awaiting_clear_confirmation'] = True
@@ -350,7 +482,7 @@ async def confirm_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if await db.clear_all_referrals():
             success_text = (
                 "✅ <b>Leaderboard Cleared!</b>\n\n"
-                "All referral counts have been reset to zero.\n"
+                "A new season has started and all referral counts are back to zero.\n"
                 "Users can start inviting again!"
             )
             await update.message.reply_text(success_text, parse_mode='HTML')
@@ -362,6 +494,115 @@ async def confirm_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in confirm_clear: {e}", exc_info=True)
         await update.message.reply_text("❌ An error occurred. Please try again later.")
 
+async def throttle_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to show command throttling counters"""
+    try:
+        user_id = update.effective_user.id
+        if user_id != ADMIN_ID:
+            logger.warning(f"Unauthorized throttle stats attempt by user {user_id}")
+            await update.message.reply_text("❌ You are not authorized to use this command.")
+            return
+        
+        stats = admission.stats()
+        stats_text = "🚦 <b>Throttle Stats</b>\n\n" + "\n".join(
+            f"{name}: {value}" for name, value in stats.items()
+        )
+        await update.message.reply_text(stats_text, parse_mode='HTML')
+    except Exception as e:
+        logger.error(f"Error showing throttle stats: {e}", exc_info=True)
+        await update.message.reply_text("❌ An error occurred. Please try again later.")
+
+def format_export_chunk(rows, export_format: str, include_header: bool = False) -> str:
+    """Render a chunk of export rows as CSV or NDJSON text"""
+    if export_format == 'ndjson':
+        return "".join(json.dumps(dict(zip(Database.EXPORT_COLUMNS, row))) + "\n" for row in rows)
+    
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if include_header:
+        writer.writerow(Database.EXPORT_COLUMNS)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to export referral data as a CSV or NDJSON document (/export [csv|ndjson])"""
+    try:
+        user_id = update.effective_user.id
+        logger.info(f"Export command received from user {user_id}")
+        
+        if user_id != ADMIN_ID:
+            logger.warning(f"Unauthorized export attempt by user {user_id}")
+            await update.message.reply_text("❌ You are not authorized to use this command.")
+            return
+        
+        export_format = context.args[0].lower() if context.args else 'csv'
+        if export_format not in EXPORT_FORMATS:
+            await update.message.reply_text("❌ Usage: /export [csv|ndjson]")
+            return
+        
+        # Stream rows to a temporary file so memory stays flat however large the table is
+        with tempfile.TemporaryFile(mode='w+b') as export_file:
+            include_header = True
+            async for rows in db.iter_export_rows():
+                export_file.write(format_export_chunk(rows, export_format, include_header).encode('utf-8'))
+                include_header = False
+            if include_header:
+                # No rows at all; still send the header
+                export_file.write(format_export_chunk([], export_format, True).encode('utf-8'))
+            export_file.seek(0)
+            
+            await update.message.reply_document(
+                document=export_file,
+                filename=f"referrals_{int(time.time())}.{export_format}",
+                caption="📦 Referral data export"
+            )
+        logger.info(f"Export sent to user {user_id}")
+    except Exception as e:
+        logger.error(f"Error exporting data: {e}", exc_info=True)
+        await update.message.reply_text("❌ Export failed. Please try again later.")
+
+async def handle_export(request):
+    """HTTP route streaming referral data as a chunked CSV or NDJSON response"""
+    if not EXPORT_ENABLED:
+        # Never accept the placeholder secret
+        return web.Response(status=404)
+    auth_header = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(auth_header.encode(), f"Bearer {WEBHOOK_SECRET}".encode()):
+        logger.warning("Invalid export authorization")
+        return web.Response(status=403)
+    
+    export_format = request.query.get('format', 'csv').lower()
+    if export_format not in EXPORT_FORMATS:
+        return web.Response(status=400, text="format must be csv or ndjson")
+    
+    response = web.StreamResponse(
+        headers={
+            'Content-Type': f"{EXPORT_FORMATS[export_format]}; charset=utf-8",
+            'Content-Disposition': f'attachment; filename="referrals.{export_format}"'
+        }
+    )
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    
+    rows_iter = db.iter_export_rows()
+    try:
+        include_header = True
+        async for rows in rows_iter:
+            await response.write(format_export_chunk(rows, export_format, include_header).encode('utf-8'))
+            include_header = False
+        if include_header:
+            await response.write(format_export_chunk([], export_format, True).encode('utf-8'))
+    except Exception as e:
+        # Headers are already sent; cut the stream short so the client sees an incomplete transfer
+        logger.error(f"Error streaming export: {e}", exc_info=True)
+        raise
+    finally:
+        await rows_iter.aclose()
+    
+    await response.write_eof()
+    logger.info(f"Export streamed as {export_format}")
+    return response
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle messages to track user activity"""
     try:
@@ -370,14 +611,60 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         user_id = update.effective_user.id
-        logger.info(f"Message received from user {user_id}")
+        logger.debug(f"Message received from user {user_id}")
         
-        # Mark user as having chatted
-        await db.mark_user_chatted(user_id)
+        # Count the message in memory; only the first message seen needs a DB write
+        if db.record_message(user_id):
+            await db.mark_user_chatted(user_id)
         
     except Exception as e:
         logger.error(f"Error handling message: {e}", exc_info=True)
 
+async def flush_activity_periodically() -> None:
+    """Background task that writes buffered message counters to the database"""
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        try:
+            await db.flush_activity()
+        except Exception as e:
+            logger.error(f"Error in activity flush task: {e}", exc_info=True)
+
+async def reconcile_referrals_continuously() -> None:
+    """Background task that walks the users table in chunks and repairs drifted referral counters"""
+    stored_cursor = await db.get_state('reconcile_cursor')
+    after_id = int(stored_cursor) if stored_cursor else 0
+    totals = {'scanned': 0, 'divergent': 0, 'repaired': 0, 'drift': 0, 'max_drift': 0}
+    
+    while True:
+        if after_id == 0:
+            # Make buffered activity visible before a new pass
+            await db.flush_activity()
+        
+        result = await db.reconcile_referrals_chunk(after_id, RECONCILE_CHUNK_SIZE)
+        if result is None:
+            # Likely contention with live traffic; back off and retry the same chunk
+            await asyncio.sleep(RECONCILE_CHUNK_DELAY * 10)
+            continue
+        
+        for key in ('scanned', 'divergent', 'repaired', 'drift'):
+            totals[key] += result[key]
+        totals['max_drift'] = max(totals['max_drift'], result['max_drift'])
+        
+        if result['last_id'] is None:
+            logger.info(f"Referral reconciliation pass complete: {totals}")
+            after_id = 0
+            totals = dict.fromkeys(totals, 0)
+            await asyncio.sleep(RECONCILE_PASS_INTERVAL)
+        else:
+            after_id = result['last_id']
+            await asyncio.sleep(RECONCILE_CHUNK_DELAY)
+
+async def report_throttle_stats_periodically() -> None:
+    """Background task that logs command throttling counters"""
+    while True:
+        await asyncio.sleep(THROTTLE_REPORT_INTERVAL)
+        logger.info(f"Throttle stats: {admission.stats()}")
+
 async def setup_webhook(application: Application) -> None:
     webhook_info = await application.bot.get_webhook_info()
     
@@ -409,8 +696,8 @@ async def setup_webhook(application: Application) -> None:
             # Set new webhook
             await application.bot.set_webhook(
                 url=WEBHOOK_URL,
-                allowed_updates=['message', 'chat_member', 'callback_query'],
-                secret_token=os.environ.get('WEBHOOK_SECRET', 'your-secret-token')
+                allowed_updates=ALLOWED_UPDATES,
+                secret_token=WEBHOOK_SECRET
             )
             logger.info("Webhook set successfully")
             
@@ -423,14 +710,99 @@ async def setup_webhook(application: Application) -> None:
     else:
         logger.info("Webhook already set correctly")
 
+class BatchCommitRequest(HTTPXRequest):
+    """Bot API request that first commits pending batch writes, so no database
+    transaction is held open across network I/O"""
+
+    async def do_request(self, *args, **kwargs):
+        await db.checkpoint()
+        return await super().do_request(*args, **kwargs)
+
+async def poll_updates(application: Application) -> None:
+    """Fetch updates with long polling and apply each batch with coalesced database writes.
+
+    Consecutive writes from the batch share one transaction, which is committed
+    before every Bot API call (see BatchCommitRequest) and at the end of the
+    batch. Each update's offset is stored next to its writes, so after a failure
+    updates whose effects were committed are skipped instead of replayed, and
+    only the update in progress can repeat its Bot API calls. Offsets are
+    acknowledged to Telegram (by the next getUpdates call) only after the batch
+    has been committed.
+    """
+    await application.bot.delete_webhook()
+    stored_offset = await db.get_state('polling_offset')
+    offset = int(stored_offset) if stored_offset else None
+    logger.info(f"Starting long polling from offset {offset}")
+    
+    while True:
+        try:
+            updates = await application.bot.get_updates(
+                offset=offset,
+                limit=POLL_BATCH_SIZE,
+                timeout=POLL_TIMEOUT,
+                allowed_updates=ALLOWED_UPDATES
+            )
+        except Exception as e:
+            logger.error(f"Error fetching updates: {e}", exc_info=True)
+            await asyncio.sleep(5)
+            continue
+        
+        if not updates:
+            continue
+        
+        try:
+            async with db.batch():
+                for update in updates:
+                    # Updates are handled one at a time, so only the current one counts
+                    # towards the load shedding backlog; the rest of the batch is not waiting on us
+                    admission.enter()
+                    try:
+                        await application.process_update(update)
+                    finally:
+                        admission.leave()
+                    await db.set_state('polling_offset', update.update_id + 1)
+        except Exception as e:
+            logger.error(f"Error applying batch of {len(updates)} updates, retrying: {e}", exc_info=True)
+            # Resume after the last update whose effects were committed
+            stored_offset = await db.get_state('polling_offset')
+            if stored_offset:
+                offset = max(offset or 0, int(stored_offset))
+            await asyncio.sleep(5)
+            continue
+        
+        offset = updates[-1].update_id + 1
+        logger.info(f"Applied batch of {len(updates)} updates, next offset {offset}")
+        
+        # Activity buffered during the batch could not be flushed while it held the write lock
+        await db.flush_activity()
+
 async def main():
     application = None
     runner = None
+    flush_task = None
+    report_task = None
+    reconcile_task = None
     try:
+        # Hosting platforms stop the bot with SIGTERM; turn it into a cancellation of this task
+        # so the cleanup below (including the final activity flush) still runs
+        loop = asyncio.get_running_loop()
+        main_task = asyncio.current_task()
+        def request_shutdown():
+            logger.info("Received SIGTERM, shutting down...")
+            loop.remove_signal_handler(signal.SIGTERM)
+            main_task.cancel()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, request_shutdown)
+        except NotImplementedError:
+            logger.warning("Signal handlers are not supported on this platform")
+
         # Initialize database first
         logger.info("Initializing database...")
         await db.init_db()
         logger.info("Database initialized successfully")
+        
+        if MEMORY_INDEX:
+            await db.load_membership_index()
 
         # Get and display server IP
         try:
@@ -443,14 +815,22 @@ async def main():
             logger.error(f"Failed to get IP address: {e}")
 
         # Initialize bot
-        application = Application.builder().token(TOKEN).build()
-
-        # Add command handlers - allow commands in both private and group chats
-        application.add_handler(CommandHandler("start", start, filters.ChatType.PRIVATE | filters.ChatType.GROUPS))
-        application.add_handler(CommandHandler("leaderboard", leaderboard, filters.ChatType.PRIVATE | filters.ChatType.GROUPS))
-        application.add_handler(CommandHandler("myreferrals", my_referrals, filters.ChatType.PRIVATE | filters.ChatType.GROUPS))
-        application.add_handler(CommandHandler("clearleaderboard", clear_leaderboard, filters.ChatType.PRIVATE | filters.ChatType.GROUPS))
-        application.add_handler(CommandHandler("confirmclear", confirm_clear, filters.ChatType.PRIVATE | filters.ChatType.GROUPS))
+        application = Application.builder().token(TOKEN).request(BatchCommitRequest(connection_pool_size=256)).build()
+
+        # Count updates queued by the application itself towards the load shedding threshold
+        admission.pending_updates = application.update_queue.qsize
+
+        # Add command handlers - allow commands in both private and group chats.
+        # Every command goes through admission control first.
+        application.add_handler(CommandHandler("start", admission.limit(start), filters.ChatType.PRIVATE | filters.ChatType.GROUPS))
+        application.add_handler(CommandHandler("leaderboard", admission.limit(leaderboard), filters.ChatType.PRIVATE | filters.ChatType.GROUPS))
+        application.add_handler(CommandHandler("myreferrals", admission.limit(my_referrals), filters.ChatType.PRIVATE | filters.ChatType.GROUPS))
+        application.add_handler(CommandHandler("mytree", admission.limit(my_tree), filters.ChatType.PRIVATE | filters.ChatType.GROUPS))
+        application.add_handler(CommandHandler("topnetworks", admission.limit(top_networks), filters.ChatType.PRIVATE | filters.ChatType.GROUPS))
+        application.add_handler(CommandHandler("clearleaderboard", admission.limit(clear_leaderboard), filters.ChatType.PRIVATE | filters.ChatType.GROUPS))
+        application.add_handler(CommandHandler("confirmclear", admission.limit(confirm_clear), filters.ChatType.PRIVATE | filters.ChatType.GROUPS))
+        application.add_handler(CommandHandler("export", admission.limit(export_data), filters.ChatType.PRIVATE | filters.ChatType.GROUPS))
+        application.add_handler(CommandHandler("throttlestats", admission.limit(throttle_stats), filters.ChatType.PRIVATE | filters.ChatType.GROUPS))
         
         # Add message handler to track chat activity
         application.add_handler(MessageHandler(filters.TEXT & filters.ChatType.GROUPS, handle_message))
@@ -461,18 +841,23 @@ async def main():
         # Set bot commands
         commands = [
             BotCommand("start", "Get your referral link"),
-            BotCommand("leaderboard", "View top 10 inviters"),
+            BotCommand("leaderboard", "View top 10 inviters (optionally for a past season)"),
             BotCommand("myreferrals", "View your referral stats"),
+            BotCommand("mytree", "View your multi-level referral tree"),
+            BotCommand("topnetworks", "View top 10 users by network size"),
             BotCommand("clearleaderboard", "Clear all referral counts (admin only)"),
-            BotCommand("confirmclear", "Confirm clearing the leaderboard (admin only)")
+            BotCommand("confirmclear", "Confirm clearing the leaderboard (admin only)"),
+            BotCommand("export", "Export referral data as CSV or NDJSON (admin only)"),
+            BotCommand("throttlestats", "View command throttling counters (admin only)")
         ]
         await application.bot.set_my_commands(commands)
         
         # Initialize the application
         await application.initialize()
         
-        # Set up webhook
-        await setup_webhook(application)
+        # Set up webhook (polling mode removes it before fetching updates)
+        if BOT_MODE != 'polling':
+            await setup_webhook(application)
         
         # Start web application
         app = web.Application()
@@ -490,7 +875,7 @@ async def main():
                 
                 # Verify webhook secret
                 secret_header = request.headers.get('X-Telegram-Bot-Api-Secret-Token')
-                if secret_header != os.environ.get('WEBHOOK_SECRET', 'your-secret-token'):
+                if secret_header != WEBHOOK_SECRET:
                     logger.warning(f"Invalid webhook secret token. Expected: {os.environ.get('WEBHOOK_SECRET')}, Got: {secret_header}")
                     return web.Response(status=403)
                 
@@ -498,7 +883,12 @@ async def main():
                 update = Update.de_json(json_data, application.bot)
                 if update:
                     logger.info(f"Successfully created Update object: {update}")
-                    await application.process_update(update)
+                    # Concurrent webhook requests make up the backlog for load shedding
+                    admission.enter()
+                    try:
+                        await application.process_update(update)
+                    finally:
+                        admission.leave()
                     logger.info("Successfully processed update")
                     return web.Response()
                 else:
@@ -510,11 +900,13 @@ async def main():
                 return web.Response(status=500)
 
         # Add routes
-        app.router.add_post(WEBHOOK_PATH, handle_webhook)
+        if BOT_MODE != 'polling':
+            app.router.add_post(WEBHOOK_PATH, handle_webhook)
+        app.router.add_get(EXPORT_PATH, handle_export)
         app.router.add_get("/", lambda r: web.Response(text="Bot is running"))
         
         # Start web server
-        logger.info(f"Starting webhook server on port {PORT}")
+        logger.info(f"Starting web server on port {PORT} in {BOT_MODE} mode")
         runner = web.AppRunner(app)
         await runner.setup()
         site = web.TCPSite(runner, '0.0.0.0', PORT)
@@ -523,21 +915,38 @@ async def main():
         # Start the application
         await application.start()
         
+        # Periodically persist buffered message counters
+        flush_task = asyncio.create_task(flush_activity_periodically())
+        report_task = asyncio.create_task(report_throttle_stats_periodically())
+        reconcile_task = asyncio.create_task(reconcile_referrals_continuously())
+        
         logger.info("Bot started successfully!")
         
-        # Keep the app running
-        while True:
-            await asyncio.sleep(3600)  # Sleep for 1 hour
+        if BOT_MODE == 'polling':
+            await poll_updates(application)
+        else:
+            # Keep the app running
+            while True:
+                await asyncio.sleep(3600)  # Sleep for 1 hour
             
+    except asyncio.CancelledError:
+        logger.info("Shutdown requested")
     except Exception as e:
         logger.error(f"Error starting bot: {e}", exc_info=True)
     finally:
         # Cleanup
         logger.info("Cleaning up...")
-        if application:
-            await application.stop()
+        # Stop taking in updates first so nothing is buffered after the final flush
         if runner:
             await runner.cleanup()
+        if application and application.running:
+            await application.stop()
+        background_tasks = [task for task in (flush_task, report_task, reconcile_task) if task]
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        # Persist any buffered message counters before exiting
+        await db.flush_activity()
 
 if __name__ == '__main__':
     import asyncio
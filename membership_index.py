@@ -0,0 +1,182 @@
+import logging
+from array import array
+from bisect import bisect_left
+
+
+class MembershipIndex:
+    """Compact in-memory copy of the membership state needed on hot read paths.
+
+    Each user occupies one slot across parallel typed arrays:
+
+    - ``_ids`` (int64): telegram id
+    - ``_inviters`` (int64): inviter telegram id, 0 for none
+    - ``_seasons`` (int32): season the user joined (or last rejoined) in
+    - ``_active`` (int32): active referrals of this user in the current season
+    - ``_member`` / ``_chatted``: one bit each in a bytearray bitset
+
+    That is 24 bytes plus 2 bits per user, about 23 MiB per million users.
+    Slots below ``_sorted_len`` are ordered by telegram id and found by binary
+    search. Users added since the last compaction sit in an unsorted tail whose
+    slots are looked up in a small dict. When the tail grows past an eighth of
+    the sorted part, every array is re-sorted in one pass. That pass briefly
+    needs a list of slot numbers (about 36 MiB per million users).
+
+    Active counts follow the default definition of an active referral: a member
+    who has chatted and joined in the current season. Inviters must be indexed
+    before their referrals, which is how the bot adds them.
+    """
+
+    def __init__(self, current_season: int = 1):
+        self.current_season = current_season
+        self._ids = array('q')
+        self._inviters = array('q')
+        self._seasons = array('i')
+        self._active = array('i')
+        self._member = bytearray()
+        self._chatted = bytearray()
+        self._sorted_len = 0
+        self._tail = {}
+        self.logger = logging.getLogger(__name__)
+
+    def load_rows(self, rows):
+        """Bulk-load (telegram_id, inviter_id, is_member, has_chatted, season_id) rows in telegram_id order.
+
+        Call repeatedly with consecutive chunks, then finish_loading() once.
+        """
+        for telegram_id, inviter_id, is_member, has_chatted, season_id in rows:
+            self._append(telegram_id, inviter_id, bool(is_member), bool(has_chatted), season_id or 1)
+        self._sorted_len = len(self._ids)
+
+    def finish_loading(self):
+        """Compute active counts once every inviter has a slot"""
+        for slot in range(len(self._ids)):
+            self._count_active(slot, 1)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def memory_bytes(self) -> int:
+        """Approximate size of the arrays and bitsets (the unsorted tail dict excluded)"""
+        return (
+            self._ids.itemsize * len(self._ids)
+            + self._inviters.itemsize * len(self._inviters)
+            + self._seasons.itemsize * len(self._seasons)
+            + self._active.itemsize * len(self._active)
+            + len(self._member)
+            + len(self._chatted)
+        )
+
+    @staticmethod
+    def _get_bit(bits: bytearray, slot: int) -> bool:
+        return bool(bits[slot >> 3] & (1 << (slot & 7)))
+
+    @staticmethod
+    def _set_bit(bits: bytearray, slot: int, value: bool):
+        if value:
+            bits[slot >> 3] |= 1 << (slot & 7)
+        else:
+            bits[slot >> 3] &= ~(1 << (slot & 7)) & 0xFF
+
+    def _append(self, telegram_id: int, inviter_id: int, is_member: bool, has_chatted: bool, season_id: int) -> int:
+        slot = len(self._ids)
+        self._ids.append(telegram_id)
+        self._inviters.append(inviter_id or 0)
+        self._seasons.append(season_id)
+        self._active.append(0)
+        if slot >> 3 >= len(self._member):
+            self._member.append(0)
+            self._chatted.append(0)
+        self._set_bit(self._member, slot, is_member)
+        self._set_bit(self._chatted, slot, has_chatted)
+        return slot
+
+    def _slot(self, telegram_id: int) -> int:
+        """Slot of a user, or None if the user is not indexed"""
+        position = bisect_left(self._ids, telegram_id, 0, self._sorted_len)
+        if position < self._sorted_len and self._ids[position] == telegram_id:
+            return position
+        return self._tail.get(telegram_id)
+
+    def _is_active(self, slot: int) -> bool:
+        return (
+            self._seasons[slot] == self.current_season
+            and self._get_bit(self._member, slot)
+            and self._get_bit(self._chatted, slot)
+        )
+
+    def _count_active(self, slot: int, delta: int):
+        """Add delta to the inviter's active count if the user in slot is an active referral"""
+        inviter_id = self._inviters[slot]
+        if not inviter_id or not self._is_active(slot):
+            return
+        inviter_slot = self._slot(inviter_id)
+        if inviter_slot is not None:
+            self._active[inviter_slot] = max(self._active[inviter_slot] + delta, 0)
+
+    def _compact(self):
+        """Merge the unsorted tail into the sorted part"""
+        order = sorted(range(len(self._ids)), key=self._ids.__getitem__)
+        member, chatted = bytearray(len(self._member)), bytearray(len(self._chatted))
+        for new_slot, old_slot in enumerate(order):
+            self._set_bit(member, new_slot, self._get_bit(self._member, old_slot))
+            self._set_bit(chatted, new_slot, self._get_bit(self._chatted, old_slot))
+        self._ids = array('q', (self._ids[slot] for slot in order))
+        self._inviters = array('q', (self._inviters[slot] for slot in order))
+        self._seasons = array('i', (self._seasons[slot] for slot in order))
+        self._active = array('i', (self._active[slot] for slot in order))
+        self._member, self._chatted = member, chatted
+        self._sorted_len = len(self._ids)
+        self._tail = {}
+        self.logger.info(f"Compacted membership index: {len(self._ids)} users, {self.memory_bytes()} bytes")
+
+    def contains(self, telegram_id: int) -> bool:
+        return self._slot(telegram_id) is not None
+
+    def get_inviter(self, telegram_id: int) -> int:
+        slot = self._slot(telegram_id)
+        if slot is None:
+            return None
+        return self._inviters[slot] or None
+
+    def is_member(self, telegram_id: int) -> bool:
+        slot = self._slot(telegram_id)
+        return slot is not None and self._get_bit(self._member, slot)
+
+    def has_chatted(self, telegram_id: int) -> bool:
+        slot = self._slot(telegram_id)
+        return slot is not None and self._get_bit(self._chatted, slot)
+
+    def active_referrals(self, telegram_id: int) -> int:
+        slot = self._slot(telegram_id)
+        return self._active[slot] if slot is not None else 0
+
+    def add(self, telegram_id: int, inviter_id: int, season_id: int):
+        """Record a new member who has not chatted yet"""
+        if self._slot(telegram_id) is not None:
+            return
+        self._tail[telegram_id] = self._append(telegram_id, inviter_id, True, False, season_id)
+        if len(self._tail) > max(1024, self._sorted_len // 8):
+            self._compact()
+
+    def set_member(self, telegram_id: int, is_member: bool, season_id: int = None):
+        """Update membership; a rejoin passes the season it happened in"""
+        slot = self._slot(telegram_id)
+        if slot is None or self._get_bit(self._member, slot) == is_member:
+            return
+        self._count_active(slot, -1)
+        self._set_bit(self._member, slot, is_member)
+        if season_id is not None:
+            self._seasons[slot] = season_id
+        self._count_active(slot, 1)
+
+    def set_chatted(self, telegram_id: int):
+        slot = self._slot(telegram_id)
+        if slot is None or self._get_bit(self._chatted, slot):
+            return
+        self._set_bit(self._chatted, slot, True)
+        self._count_active(slot, 1)
+
+    def start_season(self, season_id: int):
+        """Switch to a new season; no existing referral is active in it"""
+        self.current_season = season_id
+        self._active = array('i', bytes(self._active.itemsize * len(self._ids)))